@@ -2,9 +2,9 @@
 
 import pandas as pd
 import matplotlib.pyplot as plt
-import numpy as np
 import datetime as dt
 from util import get_data, plot_data
+from portfolio_stats import portfolio_stats
 
 
 # This is the function that will be tested by the autograder
@@ -27,13 +27,9 @@ def assess_portfolio(
 
     # Get daily portfolio value
     port_val = total_portfolio.sum(axis=1)
-    daily_returns = port_val[1:].values / port_val[:-1] - 1
 
     # Get portfolio statistics (note: std_daily_ret = volatility)
-    cr = port_val[-1] / port_val[0] - 1
-    adr = daily_returns.mean()
-    sddr = daily_returns.std()
-    sr = np.sqrt(sf) * adr / sddr
+    cr, adr, sddr, sr = portfolio_stats(port_val.values, samples_per_year=sf)
 
     # Compare daily portfolio value with SPY using a normalized plot
     if gen_plot:
@@ -3,42 +3,195 @@ import matplotlib.pyplot as plt
 import numpy as np
 import datetime as dt
 from util import get_data, plot_data
+from portfolio_stats import portfolio_stats
 import scipy.optimize as spo
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 #from analysis import get_portfolio_value, get_portfolio_stats
 
 
 def get_portfolio_stats(port_val, daily_rf=0, samples_per_year=252):
-    daily_returns = (port_val - port_val.shift(1)) / port_val.shift(1)
-    daily_returns = daily_returns[1:]
-    cr = float(port_val[-1])/port_val[0] - 1.0
-    adr = daily_returns.mean()
-    sddr = daily_returns.std()
-    sr = samples_per_year / np.sqrt(samples_per_year) * (adr - daily_rf) / sddr
+    return portfolio_stats(np.asarray(port_val), daily_rf, samples_per_year)
 
-    return cr, adr, sddr, sr
 
+def error_func(allocs, normed_prices, samples_per_year=252):
+    """Return negative Sharpe ratio of a portfolio and its gradient.
 
-def error_func(allocs, prices):
-    returns = prices / prices.ix[0]
-    port_val = (returns * allocs).sum(axis=1)
-    _, _, _, sr = get_portfolio_stats(port_val)
-    
-    return -sr
-    
-    
-def find_optimal_allocations(prices):
-    # Initializing to equal values
-    init_guess = np.ones(prices.shape[1], dtype=np.float64) * 1.0 / prices.shape[1]
-    alloc_bounds = [(0, prices.shape[1])] * prices.shape[1]
-    alloc_constraint = ({'type': 'eq', 'fun': lambda x: 1 - np.sum(x)})
+    normed_prices is a NumPy array of prices divided by their first row, so
+    a portfolio's daily value is a single matrix-vector product. The
+    gradient is analytic, sparing SLSQP one evaluation per asset.
+    """
+    values = normed_prices.dot(allocs)
+    returns = values[1:] / values[:-1] - 1
+    mean = returns.mean()
+    deviations = returns - mean
+    std = np.sqrt(deviations.dot(deviations) / (len(returns) - 1))
+
+    # d(returns)/d(allocs), one row per day
+    jacobian = (normed_prices[1:] - (1 + returns)[:, None]
+                * normed_prices[:-1]) / values[:-1, None]
+    mean_grad = jacobian.mean(axis=0)
+    std_grad = jacobian.T.dot(deviations) / ((len(returns) - 1) * std)
+
+    scale = np.sqrt(samples_per_year)
+    sr = scale * mean / std
+    sr_grad = scale * (mean_grad / std - mean * std_grad / std ** 2)
+    return -sr, -sr_grad
+
+
+def maximize_sharpe(normed_prices, init_guess=None):
+    """Run SLSQP for max Sharpe on prices normalized to their first row.
+
+    init_guess defaults to equal weights; passing a previous solution
+    warm-starts SLSQP. Returns the full scipy OptimizeResult.
+    """
+    num_assets = normed_prices.shape[1]
+    if init_guess is None:
+        init_guess = np.ones(num_assets, dtype=np.float64) * 1.0 / num_assets
+    alloc_bounds = [(0, num_assets)] * num_assets
+    alloc_constraint = ({'type': 'eq', 'fun': lambda x: 1 - np.sum(x),
+                         'jac': lambda x: -np.ones_like(x)})
     min_result = spo.minimize(error_func,
                               init_guess,
-                              args=(prices, ),
+                              args=(normed_prices, ),
                               method='SLSQP',
+                              jac=True,
                               options={'disp:': True},
                               bounds=alloc_bounds,
                               constraints=alloc_constraint)
-    return min_result.x
+    return min_result
+
+
+def optimal_allocations(normed_prices, init_guess=None):
+    """Return max-Sharpe allocations, see maximize_sharpe."""
+    return maximize_sharpe(normed_prices, init_guess).x
+
+
+def find_optimal_allocations(prices):
+    # Normalize once; every evaluation is then pure NumPy
+    return optimal_allocations(prices.values / prices.values[0])
+
+
+_shared_prices = None
+
+
+def init_multistart_worker(shared, shape):
+    """Expose the shared normalized prices to a worker without copying."""
+    global _shared_prices
+    _shared_prices = np.frombuffer(shared).reshape(shape)
+
+
+def solve_from_start(seed):
+    """Run maximize_sharpe from a random allocation; pool entry point.
+
+    Seed 0 starts from equal weights, like find_optimal_allocations.
+    """
+    num_assets = _shared_prices.shape[1]
+    if seed == 0:
+        init_guess = None
+    else:
+        init_guess = np.random.RandomState(seed).dirichlet(
+            np.ones(num_assets))
+    result = maximize_sharpe(_shared_prices, init_guess)
+    return result.x, -result.fun, result.success, result.nit
+
+
+def find_multistart_allocations(prices, num_starts=16, workers=None):
+    """Run SLSQP from many random starts in parallel and keep the best.
+
+    The normalized prices are written once to shared memory that every
+    worker process maps, rather than pickled with each task. Returns the
+    best allocations and a dict of run statistics.
+    """
+    normed_prices = prices.values / prices.values[0]
+    shared = RawArray('d', normed_prices.size)
+    np.frombuffer(shared).reshape(normed_prices.shape)[:] = normed_prices
+
+    pool = multiprocessing.Pool(workers, initializer=init_multistart_worker,
+                                initargs=(shared, normed_prices.shape))
+    try:
+        results = pool.map(solve_from_start, range(num_starts))
+    finally:
+        pool.close()
+        pool.join()
+
+    allocs, sharpes, converged, iterations = zip(*results)
+    sharpes = np.array(sharpes)
+    valid = np.where(np.array(converged), sharpes, -np.inf)
+    best = int(np.argmax(valid)) if np.isfinite(valid).any() \
+        else int(np.argmax(sharpes))
+    stats = {'starts': num_starts,
+             'converged': int(np.sum(converged)),
+             'best_start': best,
+             'sharpe_ratios': sharpes,
+             'iterations': np.array(iterations)}
+    return allocs[best] / np.sum(allocs[best]), stats
+
+
+def find_rolling_allocations(prices, window=126, step=21):
+    """Re-optimize max-Sharpe allocations over a rolling window.
+
+    Every `step` days the trailing `window` days are re-optimized, starting
+    SLSQP from the previous window's solution. Returns a DataFrame of
+    allocations indexed by the last date of each window.
+    """
+    price_values = prices.values
+    allocs = None
+    rows, dates = [], []
+    for end in xrange(window, len(price_values) + 1, step):
+        window_prices = price_values[end - window:end]
+        allocs = optimal_allocations(window_prices / window_prices[0], allocs)
+        rows.append(allocs / np.sum(allocs))
+        dates.append(prices.index[end - 1])
+    return pd.DataFrame(rows, index=dates, columns=prices.columns)
+
+
+def find_efficient_frontier(prices, num_points=20):
+    """Trace the long-only minimum-variance frontier of daily returns.
+
+    Mean daily returns and their covariance are computed once; each target
+    return on the frontier is solved from the previous point's solution.
+    Returns allocations indexed by target daily return, and the daily
+    volatility of each frontier portfolio.
+    """
+    daily_returns = prices.values[1:] / prices.values[:-1] - 1
+    mean_returns = daily_returns.mean(axis=0)
+    cov = np.cov(daily_returns, rowvar=False)
+
+    # Scale the objective so SLSQP's tolerances suit tiny daily variances
+    scaled_cov = cov / np.mean(np.diag(cov))
+
+    def variance(allocs):
+        return allocs.dot(scaled_cov).dot(allocs), 2 * scaled_cov.dot(allocs)
+
+    num_assets = prices.shape[1]
+    alloc_bounds = [(0, 1)] * num_assets
+    sum_constraint = {'type': 'eq', 'fun': lambda x: 1 - np.sum(x),
+                      'jac': lambda x: -np.ones_like(x)}
+    guess = np.ones(num_assets) * 1.0 / num_assets
+    min_variance = spo.minimize(variance, guess, method='SLSQP', jac=True,
+                                bounds=alloc_bounds,
+                                constraints=(sum_constraint, )).x
+
+    targets = np.linspace(mean_returns.dot(min_variance), mean_returns.max(),
+                          num_points)
+    guess = min_variance
+    rows = []
+    for target in targets:
+        return_constraint = {'type': 'eq',
+                             'fun': lambda x, t=target: mean_returns.dot(x) - t,
+                             'jac': lambda x: mean_returns}
+        guess = spo.minimize(variance, guess, method='SLSQP', jac=True,
+                             bounds=alloc_bounds,
+                             constraints=(sum_constraint,
+                                          return_constraint)).x
+        rows.append(guess)
+
+    allocations = pd.DataFrame(rows, index=targets, columns=prices.columns)
+    volatilities = pd.Series(np.sqrt(np.einsum('ij,jk,ik->i', allocations.values,
+                                               cov, allocations.values)),
+                             index=targets)
+    return allocations, volatilities
 
 
 # This is the function that will be tested by the autograder
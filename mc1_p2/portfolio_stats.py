@@ -0,0 +1,80 @@
+"""MLT: Portfolio statistics.
+
+Functions take portfolio values (or, for sharpe_ratio and sortino_ratio,
+daily returns) as a NumPy array with one row per day, either 1-D (a single
+portfolio) or 2-D (days x portfolios), and compute the statistic for every
+column at once. 1-D inputs give scalars, 2-D inputs give one value per
+portfolio.
+"""
+
+import numpy as np
+
+
+def daily_returns(values):
+    """Return day-over-day returns, one row shorter than values."""
+    values = np.asarray(values, dtype=np.float64)
+    return values[1:] / values[:-1] - 1
+
+
+def cumulative_return(values):
+    """Return the total return from the first to the last day."""
+    values = np.asarray(values, dtype=np.float64)
+    return values[-1] / values[0] - 1
+
+
+def sharpe_ratio(returns, daily_rf=0.0, samples_per_year=252.0):
+    """Return the annualized Sharpe ratio of daily returns."""
+    return (np.sqrt(samples_per_year) * (returns.mean(axis=0) - daily_rf)
+            / returns.std(axis=0, ddof=1))
+
+
+def sortino_ratio(returns, daily_rf=0.0, samples_per_year=252.0):
+    """Return the annualized Sortino ratio of daily returns.
+
+    Like the Sharpe ratio, but only returns below daily_rf count towards
+    the risk term.
+    """
+    excess = returns - daily_rf
+    downside = np.sqrt((np.minimum(excess, 0.0) ** 2).mean(axis=0))
+    return np.sqrt(samples_per_year) * excess.mean(axis=0) / downside
+
+
+def max_drawdown(values):
+    """Return the largest peak-to-trough loss as a positive fraction."""
+    values = np.asarray(values, dtype=np.float64)
+    peaks = np.maximum.accumulate(values, axis=0)
+    return (1 - values / peaks).max(axis=0)
+
+
+def portfolio_stats(values, daily_rf=0.0, samples_per_year=252.0):
+    """Return cumulative return, average and std of daily returns, Sharpe.
+
+    The standard deviation uses one degree of freedom, as pandas does.
+    """
+    returns = daily_returns(values)
+    cr = cumulative_return(values)
+    adr = returns.mean(axis=0)
+    sddr = returns.std(axis=0, ddof=1)
+    sr = sharpe_ratio(returns, daily_rf, samples_per_year)
+    return cr, adr, sddr, sr
+
+
+def rolling_stats(values, window, daily_rf=0.0, samples_per_year=252.0):
+    """Return rolling mean, std and Sharpe of daily returns over window days.
+
+    Each output has len(values) - window rows; row i covers the returns on
+    days i + 1 to i + window. Sums are taken from running totals, so the
+    cost does not depend on the window length.
+    """
+    returns = daily_returns(values)
+    zero = np.zeros((1,) + returns.shape[1:])
+    sums = np.concatenate((zero, np.cumsum(returns, axis=0)))
+    squares = np.concatenate((zero, np.cumsum(returns ** 2, axis=0)))
+    window_sums = sums[window:] - sums[:-window]
+    window_squares = squares[window:] - squares[:-window]
+
+    mean = window_sums / window
+    variance = (window_squares - window * mean ** 2) / (window - 1)
+    std = np.sqrt(np.maximum(variance, 0.0))
+    sharpe = np.sqrt(samples_per_year) * (mean - daily_rf) / std
+    return mean, std, sharpe
@@ -1,28 +1,414 @@
 """MLT: Utility code."""
 
 import os
+import glob
+import multiprocessing
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 
+FIELDS = ['Open', 'High', 'Low', 'Close', 'Volume', 'Adj Close']
+STORE_DIR = os.path.join("..", "data", "store")
+CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+_stores = {}
+
+
 def symbol_to_path(symbol, base_dir=os.path.join("..", "data")):
     """Return CSV file path given ticker symbol."""
     return os.path.join(base_dir, "{}.csv".format(str(symbol)))
 
-def get_data(symbols, dates, addSPY=True, colname = 'Adj Close'):
-    """Read stock data (adjusted close) for given symbols from CSV files."""
-    df = pd.DataFrame(index=dates)
+
+def field_to_path(field, store_dir=STORE_DIR):
+    """Return binary column file path given field name."""
+    return os.path.join(store_dir,
+                        "{}.npy".format(field.lower().replace(' ', '_')))
+
+
+def to_day_ordinals(dates):
+    """Convert a DatetimeIndex (or array of dates) to int64 day numbers."""
+    return np.asarray(pd.DatetimeIndex(dates).values,
+                      dtype='datetime64[D]').astype(np.int64)
+
+
+def build_store(base_dir=os.path.join("..", "data"), store_dir=STORE_DIR):
+    """Ingest every CSV in base_dir into a columnar binary store.
+
+    The store holds one dense date axis shared by all symbols and, for each
+    field, a (dates x symbols) float64 matrix saved column-major so every
+    symbol's history is contiguous on disk and can be memory-mapped.
+    """
+    paths = sorted(glob.glob(os.path.join(base_dir, "*.csv")))
+    symbols = [os.path.basename(path)[:-len(".csv")] for path in paths]
+    frames = [pd.read_csv(path, index_col='Date', parse_dates=True,
+                          usecols=['Date'] + FIELDS, na_values=['nan'])
+              for path in paths]
+
+    days = np.unique(np.concatenate(
+        [to_day_ordinals(frame.index) for frame in frames]))
+
+    if not os.path.isdir(store_dir):
+        os.makedirs(store_dir)
+    np.save(os.path.join(store_dir, "dates.npy"), days)
+    with open(os.path.join(store_dir, "symbols.txt"), "w") as f:
+        f.write("\n".join(symbols) + "\n")
+
+    rows = [np.searchsorted(days, to_day_ordinals(frame.index))
+            for frame in frames]
+    for field in FIELDS:
+        column = np.lib.format.open_memmap(
+            field_to_path(field, store_dir), mode='w+', dtype=np.float64,
+            shape=(len(days), len(symbols)), fortran_order=True)
+        column[:] = np.nan
+        for i, frame in enumerate(frames):
+            column[rows[i], i] = frame[field].values
+        column.flush()
+        del column
+
+    _stores.pop(store_dir, None)
+    _cache.clear()
+
+
+class PriceStore(object):
+    """Read-only view of a store written by build_store."""
+
+    def __init__(self, store_dir=STORE_DIR):
+        self.store_dir = store_dir
+        self.days = np.load(os.path.join(store_dir, "dates.npy"))
+        with open(os.path.join(store_dir, "symbols.txt")) as f:
+            self.symbols = f.read().split()
+        self.symbol_index = dict((s, i) for i, s in enumerate(self.symbols))
+        self.index = pd.DatetimeIndex(self.days.astype('datetime64[D]'))
+        self.columns = {}
+
+    def column(self, field):
+        """Return the memory-mapped (dates x symbols) matrix for a field."""
+        if field not in self.columns:
+            self.columns[field] = np.load(field_to_path(field, self.store_dir),
+                                          mmap_mode='r')
+        return self.columns[field]
+
+    def history(self, symbol, colname='Adj Close'):
+        """Return the full history of one symbol's field as a Series."""
+        return self.histories([symbol], colname)[0]
+
+    def histories(self, symbols, colname='Adj Close'):
+        """Return full histories of one field for many symbols as Series.
+
+        All symbols are read from the memory-mapped column in one indexing
+        operation; each Series then gets its own copy of its values so it
+        can be cached and evicted on its own.
+        """
+        for symbol in symbols:
+            if symbol not in self.symbol_index:
+                raise IOError("Symbol {} is not in store {}".format(
+                    symbol, self.store_dir))
+        cols = [self.symbol_index[s] for s in symbols]
+        rows = self.column(colname).T[cols]  # one contiguous row per symbol
+        return [pd.Series(row.copy(), index=self.index, name=colname)
+                for row in rows]
+
+
+def open_store(store_dir=STORE_DIR):
+    """Return the PriceStore in store_dir, or None if it has not been built."""
+    if store_dir not in _stores:
+        if not os.path.exists(os.path.join(store_dir, "dates.npy")):
+            return None
+        _stores[store_dir] = PriceStore(store_dir)
+    return _stores[store_dir]
+
+
+class HistoryCache(object):
+    """LRU cache of full symbol histories keyed by (symbol, colname).
+
+    Histories often share one index (all those from the binary store, or
+    the fields of one CSV read), so each distinct index is charged once,
+    while any entry still uses it.
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.indexes = {}  # id(index) -> [index, number of entries using it]
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def charge(self, series):
+        """Add a new entry's values, and its index if unseen, to nbytes."""
+        self.nbytes += series.values.nbytes
+        ref = self.indexes.setdefault(id(series.index), [series.index, 0])
+        if ref[1] == 0:
+            self.nbytes += series.index.nbytes
+        ref[1] += 1
+
+    def release(self, series):
+        """Undo charge for an entry leaving the cache."""
+        self.nbytes -= series.values.nbytes
+        ref = self.indexes[id(series.index)]
+        ref[1] -= 1
+        if ref[1] == 0:
+            self.nbytes -= series.index.nbytes
+            del self.indexes[id(series.index)]
+
+    def lookup(self, key):
+        """Return the cached value for key, or None on a miss."""
+        if key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = self.entries.pop(key)  # re-insert as most recently used
+        self.entries[key] = value
+        return value
+
+    def put(self, key, value):
+        """Insert value under key, evicting older entries if over budget."""
+        if key in self.entries:
+            self.release(self.entries.pop(key))
+        self.entries[key] = value
+        self.charge(value)
+        self.evict()
+
+    def evict(self):
+        """Drop least recently used entries until under max_bytes."""
+        while self.nbytes > self.max_bytes and len(self.entries) > 1:
+            _, value = self.entries.popitem(last=False)
+            self.release(value)
+
+    def clear(self):
+        """Drop every entry and reset the counters."""
+        self.entries.clear()
+        self.indexes.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def info(self):
+        """Return hit/miss counters and memory usage as a dict."""
+        return {'hits': self.hits, 'misses': self.misses,
+                'entries': len(self.entries), 'nbytes': self.nbytes,
+                'max_bytes': self.max_bytes}
+
+
+_cache = HistoryCache()
+
+
+def set_cache_limit(max_bytes):
+    """Bound the memory held by the get_data cache, evicting if needed."""
+    _cache.max_bytes = max_bytes
+    _cache.evict()
+
+
+def clear_cache():
+    """Empty the get_data cache."""
+    _cache.clear()
+
+
+def cache_info():
+    """Return get_data cache statistics."""
+    return _cache.info()
+
+
+def read_histories(symbol, colnames):
+    """Read full histories of several fields of one symbol in one pass.
+
+    Bypasses the cache and returns a list of Series, one per colname.
+    """
+    store = open_store()
+    if store is not None:  # binary store built, skip CSV parsing entirely
+        return [store.history(symbol, colname) for colname in colnames]
+    df = pd.read_csv(symbol_to_path(symbol), index_col='Date',
+                     parse_dates=True, usecols=['Date'] + list(colnames),
+                     na_values=['nan'])
+    df = df.sort_index()
+    return [df[colname] for colname in colnames]
+
+
+def read_store_jobs(store, jobs):
+    """Run (symbol, colnames) jobs against the binary store in bulk.
+
+    Symbols are grouped by field, so each field is read for all of its
+    symbols at once (see PriceStore.histories). Returns the same lists of
+    Series, in job order, as mapping read_histories over jobs.
+    """
+    symbols = OrderedDict()
+    for symbol, colnames in jobs:
+        for colname in colnames:
+            symbols.setdefault(colname, []).append(symbol)
+    read = {}
+    for colname, names in symbols.items():
+        for symbol, history in zip(names, store.histories(names, colname)):
+            read[symbol, colname] = history
+    return [[read[symbol, colname] for colname in colnames]
+            for symbol, colnames in jobs]
+
+
+def read_histories_job(job):
+    """Run read_histories on a (symbol, colnames) job; pool entry point."""
+    return read_histories(*job)
+
+
+def map_jobs(func, jobs, workers=1, pool='thread'):
+    """Apply func to every job, in order, optionally on a worker pool.
+
+    pool='thread' suits I/O-bound reads (e.g. the memory-mapped store),
+    pool='process' suits parse-bound reads of CSV files. Results always come
+    back in job order, so the output does not depend on scheduling.
+    """
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1 or len(jobs) <= 1:
+        return [func(job) for job in jobs]
+
+    if pool == 'thread':
+        executor = ThreadPool(workers)
+    elif pool == 'process':
+        executor = multiprocessing.Pool(workers)
+    else:
+        raise ValueError("Unknown pool type: {}".format(pool))
+    try:
+        chunksize = max(1, len(jobs) // (4 * workers))
+        return executor.map(func, jobs, chunksize)
+    finally:
+        executor.close()
+        executor.join()
+
+
+def load_universe(symbols, colnames, workers=1, pool='thread'):
+    """Return full histories of several fields for many symbols, cached.
+
+    Returns one list of Series (ordered like colnames) per symbol. Fields
+    missing from the cache are read in bulk from the binary store when one
+    has been built, otherwise together in a single pass over each symbol's
+    file, spread over workers as described in map_jobs.
+    """
+    histories = [[_cache.lookup((symbol, colname)) for colname in colnames]
+                 for symbol in symbols]
+    jobs = []
+    for symbol, fields in zip(symbols, histories):
+        missing = [colname for colname, history in zip(colnames, fields)
+                   if history is None]
+        if missing:
+            jobs.append((symbol, missing))
+
+    store = open_store()
+    if store is not None:
+        results = read_store_jobs(store, jobs)
+    else:
+        results = map_jobs(read_histories_job, jobs, workers, pool)
+    loaded = {}
+    for (symbol, missing), fields in zip(jobs, results):
+        for colname, history in zip(missing, fields):
+            _cache.put((symbol, colname), history)
+            loaded[symbol, colname] = history
+
+    return [[loaded[symbol, colname] if history is None else history
+             for colname, history in zip(colnames, fields)]
+            for symbol, fields in zip(symbols, histories)]
+
+
+def load_histories(symbol, colnames):
+    """Return full histories of several fields of one symbol, cached.
+
+    Fields missing from the cache are read together in a single pass over
+    the symbol's file.
+    """
+    return load_universe([symbol], colnames)[0]
+
+
+def load_history(symbol, colname='Adj Close'):
+    """Return the full history of one symbol's field, cached."""
+    return load_histories(symbol, [colname])[0]
+
+
+def trading_dates(histories, symbols, dates):
+    """Return the subset of dates SPY traded on, or dates if SPY is absent."""
+    dates = pd.DatetimeIndex(dates)
+    if 'SPY' not in symbols:
+        return dates
+    spy = histories[list(symbols).index('SPY')]
+    rows = spy.index.get_indexer(dates)
+    traded = rows >= 0
+    traded[traded] = pd.notnull(spy.values[rows[traded]])
+    return dates[traded]
+
+
+def align_history(history, dates, out, indexers=None):
+    """Write history's values on dates into out, leaving other rows alone.
+
+    indexers, if given, is a dict shared across calls with the same dates,
+    so histories sharing one index (as all those read from the binary store
+    do) only look the dates up once.
+    """
+    if indexers is None:
+        rows = history.index.get_indexer(dates)
+    else:
+        key = id(history.index)
+        if key not in indexers:
+            indexers[key] = history.index.get_indexer(dates)
+        rows = indexers[key]
+    found = rows >= 0
+    out[found] = history.values[rows[found]]
+
+
+def align_histories(histories, symbols, dates):
+    """Align full histories onto the SPY calendar in one wide DataFrame.
+
+    All symbols are written into a single pre-allocated (dates x symbols)
+    array which is wrapped in a DataFrame once, instead of joining frames
+    symbol by symbol.
+    """
+    dates = trading_dates(histories, symbols, dates)
+    data = np.empty((len(dates), len(symbols)))
+    data[:] = np.nan
+    indexers = {}
+    for j, history in enumerate(histories):
+        align_history(history, dates, data[:, j], indexers)
+    return pd.DataFrame(data, index=dates, columns=symbols)
+
+
+def get_data(symbols, dates, addSPY=True, colname='Adj Close', workers=1,
+             pool='thread'):
+    """Read stock data (adjusted close) for given symbols.
+
+    Full histories come from the binary store when one has been built (see
+    build_store), otherwise from the per-symbol CSV files, and are kept in an
+    LRU cache so repeated calls only slice out the requested dates. Uncached
+    symbols are loaded on `workers` threads or processes (see map_jobs).
+    """
+    if addSPY and 'SPY' not in symbols:  # add SPY for reference, if absent
+        symbols = ['SPY'] + symbols
+
+    histories = [fields[0] for fields in
+                 load_universe(symbols, [colname], workers, pool)]
+    return align_histories(histories, symbols, dates)
+
+
+def get_panel(symbols, dates, addSPY=True, colnames=FIELDS, workers=1,
+              pool='thread'):
+    """Read several fields for given symbols with one read per symbol.
+
+    Returns a DataFrame whose columns are a (colname, symbol) MultiIndex, so
+    panel['Volume'] is a plain get_data-style frame. Rows follow the SPY
+    calendar of the first colname.
+    """
     if addSPY and 'SPY' not in symbols:  # add SPY for reference, if absent
         symbols = ['SPY'] + symbols
 
-    for symbol in symbols:
-        df_temp = pd.read_csv(symbol_to_path(symbol), index_col='Date',
-                parse_dates=True, usecols=['Date', colname], na_values=['nan'])
-        df_temp = df_temp.rename(columns={colname: symbol})
-        df = df.join(df_temp)
-        if symbol == 'SPY':  # drop dates SPY did not trade
-            df = df.dropna(subset=["SPY"])
+    histories = load_universe(symbols, colnames, workers, pool)
+    dates = trading_dates([h[0] for h in histories], symbols, dates)
+    data = np.empty((len(dates), len(colnames), len(symbols)))
+    data[:] = np.nan
+    indexers = {}
+    for j, fields in enumerate(histories):
+        for k, history in enumerate(fields):
+            align_history(history, dates, data[:, k, j], indexers)
+    columns = pd.MultiIndex.from_product([list(colnames), list(symbols)])
+    return pd.DataFrame(data.reshape(len(dates), -1), index=dates,
+                        columns=columns)
 
-    return df
 
 def plot_data(df, title="Stock prices", xlabel="Date", ylabel="Price"):
     """Plot stock prices with a custom title and meaningful axis labels."""
@@ -30,3 +416,7 @@ def plot_data(df, title="Stock prices", xlabel="Date", ylabel="Price"):
     ax.set_xlabel(xlabel)
     ax.set_ylabel(ylabel)
     plt.show()
+
+
+if __name__ == "__main__":
+    build_store()
@@ -3,122 +3,329 @@
 import pandas as pd
 import numpy as np
 import datetime as dt
-from util import get_data
-
-
-def compute_portvals(orders_file="./orders/orders.csv", start_val=1000000):
-    BUY_STRING = 'BUY'
-    CASH_STRING = 'Cash'
-    CASH_MULTIPLIER = 1.0
-    DATE_STRING = 'Date'
-    DATE_FORMAT = '%Y-%m-%d'
-    EXEMPTED_DATE = '2011-06-15'
-    ORDER_STRING = 'Order'
-    SHARES_STRING = 'Shares'
-    SYMBOL_STRING = 'Symbol'
-
-    orders_df = pd.read_csv(
-        orders_file,
-        index_col=DATE_STRING,
-        parse_dates=True,
-        na_values=['nan'],
-        names=[DATE_STRING, SYMBOL_STRING, ORDER_STRING, SHARES_STRING],
-        skiprows=[0])
-
-    orders_df.index = pd.to_datetime(orders_df.index, format=DATE_FORMAT)
-    orders_df.index.to_series().apply(lambda x: x.date())
-    orders_df.sort_index(inplace=True)
-
-    # Fetch symbols, start and end dates from orders_df
-    symbols = list(set(orders_df[SYMBOL_STRING]))
-    start_date = min(orders_df.index)
-    end_date = max(orders_df.index)
+from util import get_data, to_day_ordinals
+from portfolio_stats import portfolio_stats
+
+
+BUY_STRING = 'BUY'
+DATE_STRING = 'Date'
+DATE_FORMAT = '%Y-%m-%d'
+EXEMPTED_DATE = '2011-06-15'
+ORDER_STRING = 'Order'
+SHARES_STRING = 'Shares'
+SYMBOL_STRING = 'Symbol'
+LEVERAGE_RATIO = 3.0
+COMMISSION = 0.0
+IMPACT = 0.0
+
+
+class Orders(object):
+    """A batch of orders held as parallel typed arrays.
+
+    days are int64 day numbers (days since 1970-01-01), symbol_ids are int32
+    indices into the sorted symbols list and shares are signed int64 counts
+    (negative for SELL), instead of a DataFrame of strings and timestamps.
+    """
+
+    def __init__(self, days, symbol_ids, shares, symbols):
+        self.days = days
+        self.symbol_ids = symbol_ids
+        self.shares = shares
+        self.symbols = symbols
+
+    def __len__(self):
+        return len(self.days)
+
+    @classmethod
+    def from_csv(cls, orders_file):
+        """Parse a Date,Symbol,Order,Shares file straight into typed arrays."""
+        orders_df = pd.read_csv(
+            orders_file,
+            header=0,
+            names=[DATE_STRING, SYMBOL_STRING, ORDER_STRING, SHARES_STRING],
+            dtype={DATE_STRING: str, SYMBOL_STRING: str, ORDER_STRING: str,
+                   SHARES_STRING: np.int64})
+
+        # pd.to_datetime also accepts dates that are not zero-padded
+        dates = pd.to_datetime(orders_df[DATE_STRING], format=DATE_FORMAT)
+        days = dates.values.astype('datetime64[D]')
+        symbol_ids, symbols = pd.factorize(orders_df[SYMBOL_STRING],
+                                           sort=True)
+        order_ids, order_types = pd.factorize(orders_df[ORDER_STRING])
+        is_buy = np.array([order_type.upper() == BUY_STRING
+                           for order_type in order_types], dtype=bool)
+        shares = orders_df[SHARES_STRING].values.astype(np.int64)
+        shares[~is_buy[order_ids]] *= -1
+        return cls(days.astype(np.int64), symbol_ids.astype(np.int32),
+                   shares, list(symbols))
+
+    @classmethod
+    def load(cls, path):
+        """Read orders written by save."""
+        data = np.load(path)
+        return cls(data['days'], data['symbol_ids'], data['shares'],
+                   data['symbols'].tolist())
+
+    def save(self, path):
+        """Write the orders to a binary .npz file."""
+        np.savez(path, days=self.days, symbol_ids=self.symbol_ids,
+                 shares=self.shares, symbols=np.array(self.symbols))
+
+    def select(self, mask):
+        """Return the orders where mask is True, sharing the symbol table."""
+        return Orders(self.days[mask], self.symbol_ids[mask],
+                      self.shares[mask], self.symbols)
+
+    @property
+    def start_date(self):
+        return pd.Timestamp(np.datetime64(self.days.min(), 'D'))
+
+    @property
+    def end_date(self):
+        return pd.Timestamp(np.datetime64(self.days.max(), 'D'))
+
+
+def transaction_costs(fills, shares, commission=COMMISSION, impact=IMPACT):
+    """Return the cost of each order: a flat commission plus market impact.
+
+    Impact is charged as a fraction of the traded value, so an order for
+    shares at fill price fills costs commission + impact * |fills * shares|.
+    """
+    return commission + impact * np.abs(fills * shares)
+
+
+def build_trades(days, symbol_ids, shares, prices, commission=COMMISSION,
+                 impact=IMPACT):
+    """Scatter-add orders into a dense (days x symbols) trades matrix.
+
+    days, symbol_ids and shares are parallel arrays with one entry per
+    order (row in prices, column in prices, signed share count). Returns the
+    share trades and the cash flow of each day, net of transaction costs.
+    """
+    num_days, num_symbols = prices.shape
+    trades = np.bincount(days * num_symbols + symbol_ids, weights=shares,
+                         minlength=num_days * num_symbols)
+    trades = trades.reshape(num_days, num_symbols)
+    fills = prices[days, symbol_ids]
+    flows = -fills * shares
+    if commission or impact:
+        flows -= transaction_costs(fills, shares, commission, impact)
+    cash = np.bincount(days, weights=flows, minlength=num_days)
+    return trades, cash
+
+
+def leverage(holdings, cash, prices):
+    """Return gross exposure over net assets, per row for 2-D inputs."""
+    positions = holdings * prices
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.abs(positions).sum(axis=-1) / (positions.sum(axis=-1) + cash)
+
+
+def is_overleveraged(holdings, cash, prices, leverage_ratio=LEVERAGE_RATIO):
+    """Return whether a position exceeds the gross/net exposure limit."""
+    return leverage(holdings, cash, prices) > leverage_ratio
+
+
+def accumulate(trades, cash, start_val):
+    """Return running share holdings and cash given daily trades."""
+    cash = cash.copy()
+    cash[0] += start_val
+    return np.cumsum(trades, axis=0), np.cumsum(cash)
+
+
+def compute_holdings(trades, cash, prices, start_val,
+                     leverage_ratio=LEVERAGE_RATIO, window=16):
+    """Accumulate trades into holdings, rejecting over-leveraged days.
+
+    A day whose trades would push leverage over leverage_ratio is dropped
+    in full; the first trading day is never checked. Holdings are first
+    accumulated as if every trade were accepted and leverage is evaluated
+    on blocks of days at once, with rejected trades subtracted lazily. The
+    block grows while no day is rejected and shrinks back to `window` days
+    after a rejection, so sparse rejections cost a few array passes and dense
+    ones degrade to a short sequential scan.
+    """
+    holdings, cash_holdings = accumulate(trades, cash, start_val)
+    # days without trades cannot change holdings
+    checked = np.any(trades != 0, axis=1) | (cash != 0)
+    checked[0] = False  # the first trading day is never checked
+
+    rejected = np.zeros(trades.shape[0], dtype=bool)
+    rejected_shares = np.zeros(trades.shape[1])
+    rejected_cash = 0.0
+    start, size = 1, window
+    while start < trades.shape[0]:
+        stop = min(start + size, trades.shape[0])
+        over = checked[start:stop] & is_overleveraged(
+            holdings[start:stop] - rejected_shares,
+            cash_holdings[start:stop] - rejected_cash,
+            prices[start:stop], leverage_ratio)
+        if over.any():
+            day = start + np.argmax(over)
+            rejected[day] = True
+            rejected_shares += trades[day]
+            rejected_cash += cash[day]
+            start, size = day + 1, window
+        else:
+            start, size = stop, 2 * size
+
+    if rejected.any():
+        trades, cash = trades.copy(), cash.copy()
+        trades[rejected], cash[rejected] = 0, 0
+        holdings, cash_holdings = accumulate(trades, cash, start_val)
+    return holdings, cash_holdings
+
+
+def load_orders(orders_file):
+    """Read a CSV or .npz orders file, dropping orders on the exempted date."""
+    if orders_file.endswith('.npz'):
+        orders = Orders.load(orders_file)
+    else:
+        orders = Orders.from_csv(orders_file)
+    exempted_day = np.datetime64(EXEMPTED_DATE, 'D').astype(np.int64)
+    return orders.select(orders.days != exempted_day)
+
+
+def fetch_prices(symbols, start_date, end_date):
+    """Return prices of symbols on the days SPY traded in a date range."""
     date_range = pd.date_range(start_date, end_date)
+    return get_data(symbols=symbols, dates=date_range)[symbols]
+
+
+def simulate(orders, prices_df, start_val, commission=COMMISSION,
+             impact=IMPACT):
+    """Return daily portfolio values for orders, given a price frame.
+
+    prices_df may cover more symbols and days than the orders; only the
+    orders' symbols between their first and last date are used.
+    """
+    prices_df = prices_df.loc[orders.start_date:orders.end_date,
+                              orders.symbols]
+    prices = prices_df.values
+    filled_prices = np.where(np.isnan(prices), 0.0, prices)
+
+    # Map orders onto (day, symbol) coordinates with signed share counts
+    trading_days = to_day_ordinals(prices_df.index)
+    days = np.searchsorted(trading_days, orders.days)
+    days[days == len(trading_days)] = 0
+    traded = trading_days[days] == orders.days  # skip non-trading days
+    trades, cash = build_trades(days[traded], orders.symbol_ids[traded],
+                                orders.shares[traded].astype(np.float64),
+                                filled_prices, commission, impact)
+
+    holdings, cash_holdings = compute_holdings(trades, cash, filled_prices,
+                                               start_val)
+    portvals = np.einsum('ij,ij->i', holdings, filled_prices) + cash_holdings
+    return pd.Series(portvals, index=prices_df.index)
+
+
+def compute_portvals(orders_file="./orders/orders.csv", start_val=1000000,
+                     commission=COMMISSION, impact=IMPACT):
+    orders = load_orders(orders_file)
+    prices_df = fetch_prices(orders.symbols, orders.start_date,
+                             orders.end_date)
+    return simulate(orders, prices_df, start_val, commission, impact)
+
+
+def compute_portvals_batch(orders_files, start_val=1000000,
+                           commission=COMMISSION, impact=IMPACT):
+    """Simulate many order files against a single price load.
+
+    Prices for the union of all symbols over the union of all date ranges
+    are fetched once and every order set is simulated against slices of
+    that frame. Returns a (dates x order files) DataFrame; each column
+    matches compute_portvals for that file and is NaN outside its own range.
+    """
+    orders = [load_orders(orders_file) for orders_file in orders_files]
+    symbols = sorted(set().union(*[o.symbols for o in orders]))
+    prices_df = fetch_prices(symbols,
+                             min(o.start_date for o in orders),
+                             max(o.end_date for o in orders))
+
+    portvals = np.empty((len(prices_df.index), len(orders)))
+    portvals[:] = np.nan
+    for i, order_set in enumerate(orders):
+        values = simulate(order_set, prices_df, start_val, commission,
+                          impact)
+        portvals[prices_df.index.get_indexer(values.index), i] = values.values
+    return pd.DataFrame(portvals, index=prices_df.index,
+                        columns=list(orders_files))
+
+
+class MarketSimulator(object):
+    """Incremental market simulator for orders and prices that arrive live.
+
+    Orders queue up until the next daily bar and are filled at that bar's
+    prices, as in compute_portvals. State is just the share holdings, cash
+    and last known prices, so each bar costs O(symbols) regardless of how
+    much history has been simulated.
+    """
+
+    def __init__(self, start_val=1000000, leverage_ratio=LEVERAGE_RATIO,
+                 commission=COMMISSION, impact=IMPACT):
+        self.leverage_ratio = leverage_ratio
+        self.commission = commission
+        self.impact = impact
+        self.symbols = []
+        self.symbol_ids = {}
+        self.holdings = np.zeros(0)
+        self.pending = np.zeros(0)
+        self.pending_volume = np.zeros(0)
+        self.pending_orders = 0
+        self.prices = np.zeros(0)
+        self.cash = float(start_val)
+        self.num_bars = 0
+
+    def symbol_id(self, symbol):
+        """Return the column of symbol in the state arrays, adding it if new."""
+        if symbol not in self.symbol_ids:
+            self.symbol_ids[symbol] = len(self.symbols)
+            self.symbols.append(symbol)
+            self.holdings = np.append(self.holdings, 0.0)
+            self.pending = np.append(self.pending, 0.0)
+            self.pending_volume = np.append(self.pending_volume, 0.0)
+            self.prices = np.append(self.prices, 0.0)
+        return self.symbol_ids[symbol]
+
+    def add_order(self, symbol, order, shares):
+        """Queue a BUY or SELL order to be filled at the next bar."""
+        column = self.symbol_id(symbol)
+        if order.upper() != BUY_STRING:
+            shares = -shares
+        self.pending[column] += shares
+        self.pending_volume[column] += abs(shares)
+        self.pending_orders += 1
+
+    def add_bar(self, prices):
+        """Fill queued orders at a day's prices and return the portfolio value.
+
+        prices maps symbols to that day's price; symbols missing from it (or
+        priced NaN) keep their last known price. The whole day's orders are
+        rejected if they would breach the leverage limit, except on the first
+        bar.
+        """
+        for symbol, price in prices.items():
+            if not np.isnan(price):
+                column = self.symbol_id(symbol)
+                self.prices[column] = price
+
+        proposed = self.holdings + self.pending
+        proposed_cash = (self.cash - np.dot(self.pending, self.prices)
+                         - self.commission * self.pending_orders
+                         - self.impact * np.dot(self.pending_volume,
+                                                np.abs(self.prices)))
+        if self.num_bars == 0 or not is_overleveraged(
+                proposed, proposed_cash, self.prices, self.leverage_ratio):
+            self.holdings, self.cash = proposed, proposed_cash
+        self.pending[:] = 0
+        self.pending_volume[:] = 0
+        self.pending_orders = 0
+        self.num_bars += 1
+        return self.value()
 
-    # Fetch prices for all relevant shares
-    prices = get_data(symbols=symbols, dates=date_range, addSPY=False)
-    prices[CASH_STRING] = pd.Series(CASH_MULTIPLIER, index=prices.index)
-    prices = prices[pd.notnull(prices[symbols[0]])]
-
-    # Trades will contain the number of trades performed on any given day
-    trades_df = prices.copy()
-    trades_df[trades_df != 0] = 0
-
-    for index, row in orders_df.iterrows():
-        if index != dt.datetime.strptime(EXEMPTED_DATE, DATE_FORMAT):
-            dti = pd.to_datetime(index).date()
-            previous_number_shares = trades_df.loc[index][row[SYMBOL_STRING]]
-            shares_in_order = (float(row[SHARES_STRING]) if (
-                row[ORDER_STRING].upper() == BUY_STRING) else -float(
-                    row[SHARES_STRING]))
-            updated_number_shares = previous_number_shares + shares_in_order
-            trades_df.set_value(
-                index,
-                row[SYMBOL_STRING],
-                updated_number_shares
-            )
-            cash_difference = -prices.loc[index][
-                row[SYMBOL_STRING]] * shares_in_order
-            trades_df.set_value(dti, CASH_STRING,
-                                cash_difference + trades_df.loc[index][
-                                    CASH_STRING])
-
-    holdings_df = trades_df.copy()
-    previous_date = None
-    for date in date_range:
-        if previous_date is None:
-            for symbol in symbols:
-                holdings_df.set_value(date, symbol,
-                                      float(trades_df.loc[date][symbol]))
-            holdings_df.set_value(date, CASH_STRING,
-                                  start_val + trades_df.loc[date][CASH_STRING])
-            previous_date = date
-        elif date in prices.index:
-            if is_overleveraged(
-                holdings_df=holdings_df,
-                trades_df=trades_df,
-                prices=prices,
-                date=date,
-                previous_date=previous_date,
-                symbols=symbols
-            ):
-                for symbol in symbols:
-                    holdings_df.set_value(date, symbol,
-                                          holdings_df.loc[previous_date][
-                                              symbol])
-                holdings_df.set_value(date, CASH_STRING,
-                                      holdings_df.loc[previous_date][
-                                          CASH_STRING])
-            else:
-                for symbol in symbols:
-                    holdings_df.set_value(date, symbol, float(
-                        holdings_df.loc[previous_date][symbol]) + float(
-                            trades_df.loc[date][symbol]))
-                holdings_df.set_value(date, CASH_STRING, float(
-                    holdings_df.loc[previous_date][CASH_STRING]) + float(
-                        trades_df.loc[date][CASH_STRING]))
-            previous_date = date
-
-    values = prices * holdings_df
-    portvals = values.sum(axis=1)
-    return portvals
-
-
-def is_overleveraged(holdings_df, trades_df, prices, date, previous_date,
-                     symbols):
-    CASH_STRING = 'Cash'
-    LEVERAGE_RATIO = 3.0
-    total_stock_positions = 0
-    personal_assets = 0
-    for symbol in symbols:
-        this_stocks_new_value = (holdings_df.loc[previous_date][symbol] + trades_df.loc[date][symbol]) * prices.loc[date][symbol]
-        total_stock_positions += abs(this_stocks_new_value)
-        personal_assets += this_stocks_new_value
-    personal_assets += holdings_df.loc[previous_date][CASH_STRING] \
-        + trades_df.loc[date][CASH_STRING]
-    if total_stock_positions / personal_assets > LEVERAGE_RATIO:
-        return True
-    return False
+    def value(self):
+        """Return the portfolio value at the last known prices."""
+        return np.dot(self.holdings, self.prices) + self.cash
 
 
 def test_code():
@@ -138,12 +345,9 @@ def test_code():
 
     print portvals
     # Get portfolio stats
-    daily_returns = portvals[1:].values / portvals[:-1] - 1
     sf = 245
-    cum_ret = portvals[-1] / portvals[0] - 1
-    avg_daily_ret = daily_returns.mean()
-    std_daily_ret = daily_returns.std()
-    sharpe_ratio = np.sqrt(sf) * avg_daily_ret / std_daily_ret
+    cum_ret, avg_daily_ret, std_daily_ret, sharpe_ratio = portfolio_stats(
+        portvals.values, samples_per_year=sf)
 
     start_date = dt.datetime(2008, 1, 1)
     end_date = dt.datetime(2008, 6, 1)
@@ -1,78 +1,473 @@
 __author__ = 'ANM'
 
 import numpy as np
-from random import randint
+
+
+# On-disk node record: split feature (-1 for leaves), index of the left
+# child (the right child always follows it) and split or leaf value
+NODE_DTYPE = np.dtype([('feature', np.int32), ('left', np.int32),
+                       ('value', np.float64)])
+
+# Upper bound on histogram bins built in one pass of a binned tree level
+HISTOGRAM_SLOTS = 1 << 20
+
+# Bin quantiles are taken over at most about this many evenly spaced rows
+QUANTILE_SAMPLE = 200000
+
+
+def make_bins(x_train, num_bins=256, indices=None):
+    """Return per-feature bin thresholds from quantiles of x_train.
+
+    Row f holds up to num_bins - 1 increasing thresholds for feature f,
+    padded with +inf, so every feature fits in num_bins uint8 codes.
+    indices, if given, selects the rows to take quantiles over; only one
+    column of them is gathered at a time. Beyond QUANTILE_SAMPLE rows the
+    quantiles come from an evenly spaced sample of them.
+    """
+    if num_bins > 256:
+        raise ValueError("num_bins must be at most 256 to fit in uint8 codes, "
+                         "got %d" % num_bins)
+    quantiles = np.linspace(0, 100, num_bins + 1)[1:-1]
+    thresholds = np.empty((x_train.shape[1], num_bins - 1))
+    thresholds[:] = np.inf
+    num_rows = x_train.shape[0] if indices is None else len(indices)
+    step = max(1, num_rows // QUANTILE_SAMPLE)
+    for f in xrange(x_train.shape[1]):
+        if indices is None:
+            column = x_train[::step, f]
+        else:
+            column = x_train[indices[::step], f]
+        cuts = np.unique(np.percentile(column, quantiles))
+        thresholds[f, :len(cuts)] = cuts
+    return thresholds
+
+
+def bin_features(x, thresholds):
+    """Quantize x into uint8 codes such that code <= b iff x <= threshold b.
+
+    The codes are in Fortran order, so each feature's column is contiguous.
+    """
+    codes = np.empty(x.shape, dtype=np.uint8, order='F')
+    for f in xrange(x.shape[1]):
+        codes[:, f] = np.searchsorted(thresholds[f], x[:, f], side='left')
+    return codes
 
 
 class RTLearner(object):
 
-    def __init__(self, leaf_size, verbose=False):
+    def __init__(self, leaf_size, verbose=False, num_candidates=1,
+                 num_bins=None):
         self.leaf_size = leaf_size
         self.verbose = verbose
-        self.tree = np.array([])
-
-    def get_split_indices(self, x_train, num_instances):
-        feature_index = randint(0, x_train.shape[1] - 1)
-        split_index1 = randint(0, num_instances - 1)
-        split_index2 = randint(0, num_instances - 1)
-        split_val = (x_train[split_index1][feature_index]
-                     + x_train[split_index2][feature_index])/2
-        left_indices = [i for i in xrange(x_train.shape[0])
-                        if x_train[i][feature_index] <= split_val]
-        right_indices = [i for i in xrange(x_train.shape[0])
-                         if x_train[i][feature_index] > split_val]
-        return left_indices, right_indices, feature_index, split_val
-
-    def build_tree(self, x_train, y_train):
-        num_instances = x_train.shape[0]
+        self.num_candidates = num_candidates
+        self.num_bins = num_bins
+        self.features = np.zeros(0, dtype=np.int32)
+        self.left = np.zeros(0, dtype=np.int32)
+        self.values = np.zeros(0)
+
+    def draw_candidates(self, x_train, rows, propose):
+        """Draw num_candidates random candidates among non-constant features.
+
+        Only the drawn features' columns are gathered for the rows.
+        propose(feature, column) turns a column into a candidate, or returns
+        None if the column is constant, in which case that feature is ruled
+        out and another one drawn. The list is empty if every feature is
+        constant.
+        """
+        remaining = range(x_train.shape[1])
+        columns = {}
+        candidates = []
+        while len(candidates) < self.num_candidates and remaining:
+            feature = remaining[np.random.randint(len(remaining))]
+            if feature not in columns:
+                columns[feature] = x_train[rows, feature]
+            candidate = propose(feature, columns[feature])
+            if candidate is None:
+                remaining.remove(feature)
+            else:
+                candidates.append(candidate)
+        return candidates
+
+    def propose_split(self, feature, column):
+        """Split a column at the mean of two random rows' values.
+
+        The mean is never below the column minimum, so the only degenerate
+        case is every row going left; the split then moves to the minimum,
+        which leaves at least one row on each side unless the column is
+        constant (None is returned).
+        """
+        a, b = np.random.randint(len(column), size=2)
+        split_val = (column[a] + column[b]) / 2
+        goes_left = column <= split_val
+        if goes_left.all():
+            low, high = column.min(), column.max()
+            if low == high:
+                return None
+            split_val = low
+            goes_left = column <= split_val
+        return feature, split_val, goes_left
+
+    def get_split(self, x_train, y_node, rows):
+        """Pick the best of num_candidates random splits for the given rows.
+
+        Candidates come from propose_split on random non-constant features;
+        if every feature is constant there is no split and None is returned.
+        All candidates are scored in one pass by the squared error left in
+        the two children, and the feature index, split value and left-going
+        row mask of the best are returned.
+        """
+        splits = self.draw_candidates(x_train, rows, self.propose_split)
+        if not splits:
+            return None
+        if len(splits) == 1:
+            return splits[0]
+
+        goes_left = np.column_stack([split[2] for split in splits])
+        num_left = goes_left.sum(axis=0)
+        num_right = len(rows) - num_left
+        sum_left = y_node.dot(goes_left)
+        sum_right = y_node.sum() - sum_left
+        error = (-sum_left ** 2 / num_left - sum_right ** 2 / num_right)
+        return splits[np.argmin(error)]
+
+    def propose_bin_feature(self, feature, column):
+        """Return a column of bin codes with its histogram of row counts.
+
+        None is returned if all rows fall in one bin.
+        """
+        counts = np.bincount(column, minlength=self.num_bins)
+        if np.count_nonzero(counts) == 1:
+            return None
+        return feature, column, counts
+
+    def get_binned_split(self, codes, y_node, rows):
+        """Pick the best bin boundary among num_candidates random features.
+
+        codes are uint8 bin codes from bin_features; only the candidates'
+        columns are gathered (see draw_candidates). Each candidate's
+        histograms of row counts and label sums are bincounts of its codes;
+        running sums over the stacked histograms give the squared error left
+        by every boundary of every candidate at once. Returns the feature
+        index, the bin boundary and the left-going row mask, or None if all
+        features are constant.
+        """
+        drawn = self.draw_candidates(codes, rows, self.propose_bin_feature)
+        if not drawn:
+            return None
+
+        counts = np.array([candidate[2] for candidate in drawn])
+        sums = np.array([np.bincount(candidate[1], weights=y_node,
+                                     minlength=self.num_bins)
+                         for candidate in drawn])
+        num_left = counts.cumsum(axis=1)[:, :-1]
+        sum_left = sums.cumsum(axis=1)
+        sum_right = sum_left[:, -1:] - sum_left[:, :-1]
+        sum_left = sum_left[:, :-1]
+        num_right = len(rows) - num_left
+
+        # Empty sides get a dummy count of 1 and are then ruled out
+        error = (-sum_left ** 2 / np.maximum(num_left, 1)
+                 - sum_right ** 2 / np.maximum(num_right, 1))
+        error[(num_left == 0) | (num_right == 0)] = np.inf
+        best, boundary = divmod(np.argmin(error), error.shape[1])
+        feature, column = drawn[best][:2]
+        return feature, boundary, column <= boundary
+
+    def find_binned_splits(self, columns, rows, y_rows, sizes, totals,
+                           node_of_row):
+        """Find the best bin boundary of many nodes at once.
+
+        columns is the C-contiguous transpose of the bin codes, one row per
+        feature. rows holds the nodes' rows back to back, sizes[i] of them
+        for node i, whose labels sum to totals[i]; node_of_row gives each
+        row's node. Every node draws num_candidates random features. For
+        each draw, one bincount fills a (nodes x bins) table of histograms,
+        each row starting at the lowest code present in its node, and
+        running sums along the rows give the squared error of every
+        boundary. Returns the best feature (-1 if every drawn feature was
+        constant in the node) and bin boundary of each node, and which rows
+        go left.
+        """
+        num_nodes = sizes.size
+        starts = np.cumsum(sizes) - sizes
+        candidates = np.random.randint(columns.shape[0],
+                                       size=(num_nodes, self.num_candidates))
+        best_error = np.empty(num_nodes)
+        best_error[:] = np.inf
+        best_feature = np.empty(num_nodes, dtype=np.intp)
+        best_feature[:] = -1
+        best_boundary = np.zeros(num_nodes, dtype=np.intp)
+        best_column = None
+
+        for j in xrange(self.num_candidates):
+            column = columns.ravel().take(
+                rows + (candidates[:, j] * columns.shape[1])[node_of_row])
+            lows = np.minimum.reduceat(column, starts).astype(np.intp)
+            width = int((np.maximum.reduceat(column, starts) - lows).max()) + 1
+            slots = column + (width * np.arange(num_nodes) - lows)[node_of_row]
+            shape = (num_nodes, width)
+            num_left = np.bincount(slots, minlength=num_nodes * width)
+            sum_left = np.bincount(slots, weights=y_rows,
+                                   minlength=num_nodes * width)
+            num_left = num_left.reshape(shape).cumsum(axis=1)
+            sum_left = sum_left.reshape(shape).cumsum(axis=1)
+            num_right = sizes[:, None] - num_left
+            sum_right = totals[:, None] - sum_left
+
+            # A node's first bin is never empty, so only the right side can
+            # be; such boundaries get a dummy count of 1 and are then ruled
+            # out. An empty bin scores exactly like the bin before it, which
+            # argmin keeps.
+            error = (-sum_left ** 2 / num_left
+                     - sum_right ** 2 / np.maximum(num_right, 1))
+            error[num_right == 0] = np.inf
+            boundary = np.argmin(error, axis=1)
+            node_error = error[np.arange(num_nodes), boundary]
+            boundary += lows
+
+            better = node_error < best_error
+            best_error[better] = node_error[better]
+            best_feature[better] = candidates[better, j]
+            best_boundary[better] = boundary[better]
+            if best_column is None:
+                best_column = column
+            else:
+                np.copyto(best_column, column, where=better[node_of_row])
+        goes_left = best_column <= best_boundary.astype(np.uint8)[node_of_row]
+        return best_feature, best_boundary, goes_left
+
+    def build_binned_tree(self, codes, y_train, indices=None):
+        """Build a tree on bin codes one level at a time.
+
+        All nodes of a level are handled together: their rows and labels are
+        kept back to back, grouped by node, their splits come from
+        find_binned_splits in batches of at most HISTOGRAM_SLOTS bins, and
+        all rows are partitioned at once, so the Python loop runs per level
+        rather than per node. Rows of finished leaves are dropped. A node
+        whose drawn features were all constant retries with
+        get_binned_split, which only draws varying features. Node values
+        store the float thresholds of the chosen boundaries so queries use
+        raw features.
+        """
+        if indices is None:
+            indices = np.arange(codes.shape[0])
+        num_instances = len(indices)
+        capacity = max(2 * num_instances - 1, 1)
+        features = np.empty(capacity, dtype=np.int32)
+        left = np.empty(capacity, dtype=np.int32)
+        values = np.empty(capacity)
         if num_instances == 0:
-            print 'all -1s'
-            return np.array([-1, -1, -1, -1])
-        if num_instances <= self.leaf_size:
-            # If there's only one instance, take the mean of the labels
-            return np.array([-1, np.mean(y_train), -1, -1])
-
-        values = np.unique(y_train)
-        if len(values) == 1:
-            # If all instances have the same label, return that label
-            return np.array([-1, y_train[0], -1, -1])
-
-        # Choose a random feature, and a random split value
-        left_indices, right_indices, feature_index, split_val = \
-            self.get_split_indices(x_train, num_instances)
-
-        while len(left_indices) < 1 or len(right_indices) < 1:
-            left_indices, right_indices, feature_index, split_val = \
-                self.get_split_indices(x_train, num_instances)
-
-        left_x_train = np.array([x_train[i] for i in left_indices])
-        left_y_train = np.array([y_train[i] for i in left_indices])
-        right_x_train = np.array([x_train[i] for i in right_indices])
-        right_y_train = np.array([y_train[i] for i in right_indices])
-
-        left_tree = self.build_tree(left_x_train, left_y_train)
-        right_tree = self.build_tree(right_x_train, right_y_train)
-        if len(left_tree.shape) == 1:
-            num_left_side_instances = 2
-        else:
-            num_left_side_instances = left_tree.shape[0] + 1
-        root = [feature_index, split_val, 1, num_left_side_instances]
-        return np.vstack((root, np.vstack((left_tree, right_tree))))
-
-    def addEvidence(self, Xtrain, Ytrain):
-        self.tree = self.build_tree(Xtrain, Ytrain)
-
-    def traverse_tree(self, instance, row=0):
-        feature_index = int(self.tree[row][0])
-        if feature_index == -1:
-            return self.tree[row][1]
-        if instance[feature_index] <= self.tree[row][1]:
-            return self.traverse_tree(instance, row + int(self.tree[row][2]))
-        else:
-            return self.traverse_tree(instance, row + int(self.tree[row][3]))
+            features[0], left[0], values[0] = -1, -1, -1
+            return features, left, values
+
+        # Feature-major, so a node's column is gathered from one short run;
+        # histograms ignore row order, so rows are sorted for locality
+        columns = np.ascontiguousarray(codes.T)
+        rows = np.sort(np.asarray(indices, dtype=np.intp))
+        y_rows = y_train[rows]
+        nodes = np.zeros(1, dtype=np.intp)
+        sizes = np.array([num_instances], dtype=np.intp)
+        num_nodes = 1
+        batch = max(1, HISTOGRAM_SLOTS // self.num_bins)
+        while nodes.size:
+            starts = np.cumsum(sizes) - sizes
+            totals = np.add.reduceat(y_rows, starts)
+            # Small enough, or all labels equal: take the mean label
+            leaf = ((sizes <= self.leaf_size)
+                    | (np.minimum.reduceat(y_rows, starts)
+                       == np.maximum.reduceat(y_rows, starts)))
+            if leaf.any():
+                features[nodes[leaf]] = -1
+                left[nodes[leaf]] = -1
+                values[nodes[leaf]] = totals[leaf] / sizes[leaf]
+                keep = ~leaf
+                row_keep = np.repeat(keep, sizes)
+                rows, y_rows = rows[row_keep], y_rows[row_keep]
+                nodes, sizes, totals = nodes[keep], sizes[keep], totals[keep]
+                starts = np.cumsum(sizes) - sizes
+            if not nodes.size:
+                break
+            node_of_row = np.repeat(np.arange(nodes.size), sizes)
+
+            split_features = np.empty(nodes.size, dtype=np.intp)
+            boundaries = np.empty(nodes.size, dtype=np.intp)
+            goes_left = np.empty(rows.size, dtype=bool)
+            for b in xrange(0, nodes.size, batch):
+                e = min(b + batch, nodes.size)
+                lo, hi = starts[b], starts[e - 1] + sizes[e - 1]
+                split_features[b:e], boundaries[b:e], goes_left[lo:hi] = \
+                    self.find_binned_splits(columns, rows[lo:hi],
+                                            y_rows[lo:hi], sizes[b:e],
+                                            totals[b:e],
+                                            node_of_row[lo:hi] - b)
+            for i in np.flatnonzero(split_features == -1):
+                node_rows = slice(starts[i], starts[i] + sizes[i])
+                split = self.get_binned_split(codes, y_rows[node_rows],
+                                              rows[node_rows])
+                if split is not None:
+                    split_features[i], boundaries[i] = split[:2]
+                    goes_left[node_rows] = split[2]
+
+            # Every feature constant: nothing left to split on
+            constant = split_features == -1
+            if constant.any():
+                features[nodes[constant]] = -1
+                left[nodes[constant]] = -1
+                values[nodes[constant]] = (totals[constant]
+                                           / sizes[constant])
+                keep = ~constant
+                row_keep = np.repeat(keep, sizes)
+                rows, y_rows = rows[row_keep], y_rows[row_keep]
+                goes_left = goes_left[row_keep]
+                nodes, sizes = nodes[keep], sizes[keep]
+                split_features = split_features[keep]
+                boundaries = boundaries[keep]
+                starts = np.cumsum(sizes) - sizes
+                if not nodes.size:
+                    break
+                node_of_row = np.repeat(np.arange(nodes.size), sizes)
+
+            children = num_nodes + 2 * np.arange(nodes.size)
+            features[nodes] = split_features
+            left[nodes] = children
+            values[nodes] = self.thresholds[split_features, boundaries]
+            num_nodes += 2 * nodes.size
+
+            # Next level: every left child in node order, then every right
+            # child; taking rows in this order keeps each child's rows sorted
+            order = np.concatenate((np.flatnonzero(goes_left),
+                                    np.flatnonzero(~goes_left)))
+            num_left = np.add.reduceat(goes_left, starts, dtype=np.intp)
+            rows, y_rows = rows.take(order), y_rows.take(order)
+            nodes = np.concatenate((children, children + 1))
+            sizes = np.concatenate((num_left, sizes - num_left))
+        return (features[:num_nodes].copy(), left[:num_nodes].copy(),
+                values[:num_nodes].copy())
+
+    def build_tree(self, x_train, y_train, indices=None):
+        """Build the tree iteratively into pre-allocated node arrays.
+
+        Rows are never copied: each pending node owns a slice [lo, hi) of a
+        single permutation of row indices, which is partitioned in place
+        when the node splits. Nodes are stored as parallel arrays of split
+        feature (-1 for leaves), left child index and split or leaf value;
+        both children are allocated together, so the right child is always
+        left + 1. indices, if given, selects (possibly repeated) training
+        rows, e.g. a bootstrap sample, without copying them.
+
+        When num_bins is set, x_train holds uint8 bin codes and the tree is
+        built by build_binned_tree instead.
+        """
+        if self.num_bins:
+            return self.build_binned_tree(x_train, y_train, indices)
+        if indices is None:
+            indices = np.arange(x_train.shape[0])
+        num_instances = len(indices)
+        capacity = max(2 * num_instances - 1, 1)
+        features = np.empty(capacity, dtype=np.int32)
+        left = np.empty(capacity, dtype=np.int32)
+        values = np.empty(capacity)
+        if num_instances == 0:
+            features[0], left[0], values[0] = -1, -1, -1
+            return features, left, values
+
+        order = np.array(indices, dtype=np.intp)
+        num_nodes = 1
+        stack = [(0, 0, num_instances)]
+        while stack:
+            node, lo, hi = stack.pop()
+            rows = order[lo:hi]
+            y_node = y_train[rows]
+            if hi - lo <= self.leaf_size or y_node.min() == y_node.max():
+                # Small enough, or all labels equal: take the mean label
+                features[node], left[node] = -1, -1
+                values[node] = np.mean(y_node)
+                continue
+
+            split = self.get_split(x_train, y_node, rows)
+            if split is None:
+                # Every row has the same features: nothing left to split on
+                features[node], left[node] = -1, -1
+                values[node] = np.mean(y_node)
+                continue
+            feature_index, split_val, goes_left = split
+            mid = lo + np.count_nonzero(goes_left)
+            if mid == lo or mid == hi:
+                # A split with an empty side would repeat this node forever
+                features[node], left[node] = -1, -1
+                values[node] = np.mean(y_node)
+                continue
+            order[lo:hi] = np.concatenate((rows[goes_left],
+                                           rows[~goes_left]))
+
+            features[node], left[node] = feature_index, num_nodes
+            values[node] = split_val
+            stack.append((num_nodes + 1, mid, hi))
+            stack.append((num_nodes, lo, mid))
+            num_nodes += 2
+        return (features[:num_nodes].copy(), left[:num_nodes].copy(),
+                values[:num_nodes].copy())
+
+    def addEvidence(self, Xtrain, Ytrain, indices=None, thresholds=None):
+        """Train on Xtrain, or on the rows of it selected by indices.
+
+        When num_bins is set, training runs on uint8 bin codes, 1/8 the
+        memory of the float features. Passing the thresholds from make_bins
+        says Xtrain already holds the matching bin_features codes, so data
+        shared by several learners only has to be binned once.
+        """
+        if self.num_bins:
+            if thresholds is None:
+                thresholds = make_bins(Xtrain, self.num_bins, indices)
+                Xtrain = bin_features(Xtrain, thresholds)
+            self.thresholds = thresholds
+        self.features, self.left, self.values = \
+            self.build_tree(Xtrain, Ytrain, indices)
+
+    @property
+    def tree(self):
+        """Return the tree as rows of [feature, value, left, right].
+
+        Child positions are relative to the row, as in earlier versions.
+        """
+        rows = np.arange(len(self.features))
+        leaves = self.features == -1
+        left = np.where(leaves, -1, self.left - rows)
+        right = np.where(leaves, -1, self.left + 1 - rows)
+        return np.column_stack((self.features, self.values, left, right))
+
+    def save(self, path):
+        """Write the tree to a .npy file of NODE_DTYPE records."""
+        nodes = np.empty(len(self.features), dtype=NODE_DTYPE)
+        nodes['feature'] = self.features
+        nodes['left'] = self.left
+        nodes['value'] = self.values
+        np.save(path, nodes)
+
+    def load(self, path, mmap_mode='r'):
+        """Read a tree written by save, memory-mapped by default."""
+        nodes = np.load(path, mmap_mode=mmap_mode)
+        self.features = nodes['feature']
+        self.left = nodes['left']
+        self.values = nodes['value']
 
     def query(self, Xtest):
-        result = []
-        for instance in Xtest:
-            result.append(self.traverse_tree(instance))
-        return np.array(result)
\ No newline at end of file
+        """Route all rows down the tree together, one level per pass.
+
+        Each pass looks up the current node of every row still at an inner
+        node and moves it to the left or right child with array indexing,
+        so the Python loop runs once per tree level rather than per row.
+        """
+        Xtest = np.asarray(Xtest)
+        features, left, values = self.features, self.left, self.values
+
+        nodes = np.zeros(Xtest.shape[0], dtype=np.intp)
+        active = np.arange(Xtest.shape[0])
+        while active.size:
+            current = nodes[active]
+            inner = features[current] != -1
+            active, current = active[inner], current[inner]
+            goes_right = (Xtest[active, features[current]]
+                          > values[current])
+            nodes[active] = left[current] + goes_right
+        return values[nodes]
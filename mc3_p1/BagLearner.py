@@ -1,8 +1,41 @@
 __author__ = 'ANM'
 
+import os
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
 import numpy as np
 import RTLearner
-from random import randint
+
+# Arrays and learners handed to pool workers through their initializer
+_shared = {}
+
+
+def share_array(array, dtype=np.float64):
+    """Copy an array into shared memory; returns (buffer, shape, dtype)."""
+    array = np.asarray(array, dtype=dtype)
+    shared = RawArray('B', array.nbytes)
+    np.frombuffer(shared, dtype=array.dtype).reshape(array.shape)[:] = array
+    return shared, array.shape, array.dtype
+
+
+def init_worker(arrays, learners=None):
+    """Map shared arrays (and learners) into a pool worker."""
+    for name, (shared, shape, dtype) in arrays.items():
+        _shared[name] = np.frombuffer(shared, dtype=dtype).reshape(shape)
+    _shared['learners'] = learners
+
+
+def train_bag_job(job):
+    """Train one bag on the shared training data; pool entry point."""
+    learner, seed = job
+    return BagLearner.train_bag(learner, _shared['Xtrain'],
+                                _shared['Ytrain'], seed,
+                                _shared.get('thresholds'))
+
+
+def query_bag_job(index):
+    """Query one trained bag on the shared test data; pool entry point."""
+    return _shared['learners'][index].query(_shared['Xtest'])
 
 
 class BagLearner(object):
@@ -14,38 +47,115 @@ class BagLearner(object):
                  kwargs={"leaf_size": 1},
                  bags=20,
                  boost=False,
-                 verbose=False):
+                 verbose=False,
+                 workers=1,
+                 seed=None):
 
+        self.workers = workers
+        self.seed = seed
+        self.learner = learner
+        self.kwargs = kwargs
         self.learners = []
         for i in xrange(bags):
             self.learners.append(learner(**kwargs))
 
     @staticmethod
     def get_random_indices(n, n_prime_percent):
-        indices = []
-        for i in xrange(int(n_prime_percent * n)):
-            indices.append(randint(0, n - 1))
-        return indices
+        return np.random.randint(0, n, size=int(n_prime_percent * n))
+
+    @staticmethod
+    def train_bag(learner, Xtrain, Ytrain, seed, thresholds=None):
+        """Train learner on a bootstrap sample drawn from seed.
+
+        The sample is only an index array into Xtrain and Ytrain; learners
+        read rows through it instead of receiving copied sub-matrices. The
+        global NumPy random state is restored afterwards, so training does
+        not reset the caller's random stream. thresholds, if given, are
+        passed on with Xtrain holding pre-binned codes (see addEvidence).
+        """
+        state = np.random.get_state()
+        try:
+            np.random.seed(seed)
+            indices = BagLearner.get_random_indices(
+                Xtrain.shape[0], BagLearner.N_PRIME_PERCENT)
+            if thresholds is None:
+                learner.addEvidence(Xtrain, Ytrain, indices)
+            else:
+                learner.addEvidence(Xtrain, Ytrain, indices, thresholds)
+        finally:
+            np.random.set_state(state)
+        return learner
+
+    def make_pool(self, arrays, learners=None):
+        """Start a process pool whose workers map the given shared arrays."""
+        return multiprocessing.Pool(self.workers, initializer=init_worker,
+                                    initargs=(arrays, learners))
 
     def addEvidence(self, Xtrain, Ytrain):
-        for learner in self.learners:
-            indices = BagLearner.get_random_indices(Xtrain.shape[0],
-                                                    self.N_PRIME_PERCENT)
-            current_x_train = []
-            current_y_train = []
-            for index in indices:
-                current_x_train.append(Xtrain[index])
-                current_y_train.append(Ytrain[index])
-            learner.addEvidence(np.array(current_x_train),
-                                np.array(current_y_train))
+        """Train every bag, on `workers` processes when more than one.
+
+        Each bag draws its sample and splits from its own seed, derived from
+        self.seed, so results do not depend on the number of workers.
+        Training data is placed in shared memory once rather than pickled
+        for every bag. Learners given num_bins get the data binned once
+        here, so all bags share one uint8 copy instead of each binning (and
+        keeping) the float features.
+        """
+        seeds = np.random.RandomState(self.seed).randint(
+            2 ** 31 - 1, size=len(self.learners))
+        thresholds = None
+        if self.kwargs.get('num_bins'):
+            thresholds = RTLearner.make_bins(Xtrain, self.kwargs['num_bins'])
+            Xtrain = RTLearner.bin_features(Xtrain, thresholds)
+        if self.workers <= 1:
+            self.learners = [BagLearner.train_bag(learner, Xtrain, Ytrain, s,
+                                                  thresholds)
+                             for learner, s in zip(self.learners, seeds)]
+            return
+
+        arrays = {'Ytrain': share_array(Ytrain)}
+        if thresholds is None:
+            arrays['Xtrain'] = share_array(Xtrain)
+        else:
+            arrays['Xtrain'] = share_array(Xtrain, np.uint8)
+            arrays['thresholds'] = share_array(thresholds)
+        pool = self.make_pool(arrays)
+        try:
+            self.learners = pool.map(train_bag_job,
+                                     zip(self.learners, seeds), 1)
+        finally:
+            pool.close()
+            pool.join()
 
     def query(self, Xtest):
-        results = None
-        for learner in self.learners:
-            current_result = learner.query(Xtest)
-            if results is None:
-                results = current_result
-            else:
-                results = np.add(results, current_result)
-        results /= len(self.learners)
-        return results
+        """Average the bags' predictions, queried in parallel if workers > 1."""
+        if self.workers <= 1:
+            results = [learner.query(Xtest) for learner in self.learners]
+        else:
+            pool = self.make_pool({'Xtest': share_array(Xtest)},
+                                  self.learners)
+            try:
+                results = pool.map(query_bag_job,
+                                   range(len(self.learners)), 1)
+            finally:
+                pool.close()
+                pool.join()
+        return np.mean(results, axis=0)
+
+    def save(self, directory):
+        """Write each bag's model to its own file in directory."""
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for i, learner in enumerate(self.learners):
+            learner.save(os.path.join(directory, 'bag{:03d}.npy'.format(i)))
+
+    def load(self, directory, mmap_mode='r'):
+        """Read models written by save, one learner per file."""
+        paths = sorted(os.path.join(directory, name)
+                       for name in os.listdir(directory)
+                       if name.startswith('bag') and name.endswith('.npy'))
+        self.learners = []
+        for path in paths:
+            learner = self.learner(**self.kwargs)
+            learner.load(path, mmap_mode=mmap_mode)
+            self.learners.append(learner)
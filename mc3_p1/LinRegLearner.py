@@ -2,20 +2,53 @@
 A simple wrapper for linear regression.  (c) 2015 Tucker Balch
 """
 
+import itertools
 import numpy as np
 
 
+def read_array_chunks(path, chunk_rows=100000, delimiter=','):
+    """Yield a headerless numeric CSV as float arrays of up to chunk_rows rows.
+
+    Only one block is held in memory at a time, so files larger than memory
+    can be streamed into LinRegLearner.addEvidenceFromChunks.
+    """
+    with open(path) as f:
+        while True:
+            lines = list(itertools.islice(f, chunk_rows))
+            if not lines:
+                return
+            yield np.loadtxt(lines, delimiter=delimiter, ndmin=2)
+
+
 class LinRegLearner(object):
 
-    def __init__(self, verbose = False):
-        pass  # move along, these aren't the drones you're looking for
+    def __init__(self, verbose = False, online = False, forgetting = 1.0):
+        """
+        @param online: if True, each addEvidence call updates the model
+        with a new batch instead of replacing it
+        @param forgetting: in online mode, weight applied to all earlier
+        batches each time a new one arrives (1.0 keeps them all equally)
+        """
+        self.online = online
+        self.forgetting = forgetting
+        self.xtx = None  # running [X 1]'[X 1]
+        self.xty = None  # running [X 1]'Y
 
-    def addEvidence(self, dataX, dataY):
+    def addEvidence(self, dataX, dataY, indices=None):
         """
         @summary: Add training data to learner
         @param dataX: X values of data to add
-        @param dataY: the Y training values
+        @param dataY: the Y training values, either one value per row or a
+        matrix with one column per target; all targets share one fit
+        @param indices: optional rows of dataX/dataY to train on
         """
+        if indices is not None:
+            dataX, dataY = dataX[indices], dataY[indices]
+
+        if self.online:
+            self.update_statistics(dataX, dataY)
+            self.model_coefs = np.linalg.lstsq(self.xtx, self.xty)[0]
+            return
 
         # slap on 1s column so linear regression finds a constant term
         newdataX = np.ones([dataX.shape[0],dataX.shape[1]+1])
@@ -24,15 +57,66 @@ class LinRegLearner(object):
         # build and save the model
         self.model_coefs, residuals, rank, s = np.linalg.lstsq(newdataX, dataY)
         
+    def addEvidenceFromChunks(self, chunks, num_targets=1):
+        """
+        @summary: Train from an iterable of data blocks, e.g. from
+        read_array_chunks, without holding the whole dataset
+        @param chunks: arrays whose last num_targets columns are Y and
+        others are X
+        In online mode the blocks together count as one new batch. Raises
+        ValueError if the blocks hold no rows.
+        """
+        if not self.online:
+            self.xtx = self.xty = None
+        forgetting = self.forgetting
+        num_rows = 0
+        for chunk in chunks:
+            num_rows += chunk.shape[0]
+            dataY = chunk[:, -num_targets:]
+            if num_targets == 1:
+                dataY = dataY[:, 0]
+            self.update_statistics(chunk[:, :-num_targets], dataY, forgetting)
+            forgetting = 1.0
+        if num_rows == 0:
+            raise ValueError("addEvidenceFromChunks got no rows to train on")
+        self.model_coefs = np.linalg.lstsq(self.xtx, self.xty)[0]
+
+    def update_statistics(self, dataX, dataY, forgetting=None):
+        """
+        @summary: Fold a batch into the normal-equation sufficient statistics
+        @param dataX: X values of the batch
+        @param dataY: the Y values of the batch
+        @param forgetting: weight for the earlier statistics, defaults to
+        self.forgetting
+        The constant term is handled blockwise, so no copy of dataX with a
+        1s column is made.
+        """
+        if forgetting is None:
+            forgetting = self.forgetting
+        num_features = dataX.shape[1]
+        xtx = np.empty((num_features + 1, num_features + 1))
+        xtx[:num_features, :num_features] = dataX.T.dot(dataX)
+        xtx[:num_features, -1] = xtx[-1, :num_features] = dataX.sum(axis=0)
+        xtx[-1, -1] = dataX.shape[0]
+        xty = np.concatenate((dataX.T.dot(dataY),
+                              np.sum(dataY, axis=0, keepdims=True)))
+
+        if self.xtx is None:
+            self.xtx, self.xty = xtx, xty
+        else:
+            self.xtx = forgetting * self.xtx + xtx
+            self.xty = forgetting * self.xty + xty
+
     def query(self,points):
         """
         @summary: Estimate a set of test points given the model we built.
         @param points: should be a numpy array with each row corresponding to a
         specific query.
-        @returns the estimated values according to the saved model.
+        @returns the estimated values according to the saved model, with one
+        column per target if the model was trained on several.
         """
-        return \
-            (self.model_coefs[:-1] * points).sum(axis=1) + self.model_coefs[-1]
+        points = np.asarray(points)
+        return points.dot(self.model_coefs[:-1]) + self.model_coefs[-1]
 
 if __name__ == "__main__":
     print "the secret clue is 'zzyzx'"
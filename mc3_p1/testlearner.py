@@ -13,8 +13,7 @@ if __name__ == "__main__":
     if len(sys.argv) != 2:
         print "Usage: python testlearner.py <filename>"
         sys.exit(1)
-    inf = open(sys.argv[1])
-    data = np.array([map(float, s.strip().split(',')) for s in inf.readlines()])
+    data = np.concatenate(list(lrl.read_array_chunks(sys.argv[1])))
 
     # compute how much of the data is training and testing
     train_rows = math.floor(0.6 * data.shape[0])
@@ -22,16 +22,16 @@ class StrategyLearner(object):
         self.learner = ql.QLearner()
         # add your code to do learning here
 
-        # example usage of the old backward compatible util function
+        # read prices and volume in a single pass over each file
         syms=[symbol]
         dates = pd.date_range(sd, ed)
-        prices_all = ut.get_data(syms, dates)  # automatically adds SPY
+        panel = ut.get_panel(syms, dates, colnames = ['Adj Close', 'Volume'])  # automatically adds SPY
+        prices_all = panel['Adj Close']
         prices = prices_all[syms]  # only portfolio symbols
         prices_SPY = prices_all['SPY']  # only SPY, for comparison later
         if self.verbose: print prices
   
-        # example use with new colname 
-        volume_all = ut.get_data(syms, dates, colname = "Volume")  # automatically adds SPY
+        volume_all = panel['Volume']
         volume = volume_all[syms]  # only portfolio symbols
         volume_SPY = volume_all['SPY']  # only SPY, for comparison later
         if self.verbose: print volume